@@ -0,0 +1,75 @@
+import os
+import pandas as pd
+from torch.utils.data import DataLoader, Dataset
+from torchvision.transforms import v2
+from torchvision.io import read_image, ImageReadMode
+from tqdm.auto import tqdm
+import numpy as np
+
+# Configuration settings; data_dir/cache_dir must match the training scripts
+CONFIG = {
+    "batch_size": 64,
+    "num_workers": 8,
+    "data_dir": "/projectnb/dl4ds/projects/dca_project/nih_data",
+    "cache_dir": "/projectnb/dl4ds/projects/dca_project/nih_data/cache",
+    "image_size": 256,  # Every training script crops/resizes down from this resolution
+}
+
+# Decode straight to uint8 CHW tensors with libpng and resize to the shared cache resolution
+resize = v2.Resize((CONFIG["image_size"], CONFIG["image_size"]), antialias=True)
+
+class PNGDataset(Dataset):
+    def __init__(self, dataframe):
+        self.img_paths = [os.path.join(folder, name) for name, folder in zip(dataframe['Image Index'], dataframe['folder'])]
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        image = read_image(self.img_paths[idx], mode=ImageReadMode.RGB)
+        return resize(image)
+
+# The build runs behind the __main__ guard so spawn-started DataLoader workers, which re-import this
+# module, do not rescan the folders or reopen (and truncate) the memmap being written
+def main():
+    # Get list of all image folders from images_001 to images_012
+    data_path = CONFIG["data_dir"]
+    image_folders = [os.path.join(data_path, f"images_{str(i).zfill(3)}", "images") for i in range(1, 13)]
+
+    # List the PNGs in every image folder; os.scandir reads names without an extra stat() per file
+    image_files = []
+    for folder in image_folders:
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.name.endswith('.png'):
+                    image_files.append((entry.name, folder))
+    image_index = pd.DataFrame(image_files, columns=['Image Index', 'folder']).drop_duplicates('Image Index', keep='last')
+    image_index = image_index.sort_values('Image Index').reset_index(drop=True)
+    if image_index.empty:
+        raise ValueError(f"No images found under {data_path}")
+
+    # Row i of images_u8.npy is the image named in row i of images_index.parquet. Both files are
+    # written under a temporary name first so an interrupted build is never picked up
+    os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+    images_file = os.path.join(CONFIG["cache_dir"], "images_u8.npy")
+    index_file = os.path.join(CONFIG["cache_dir"], "images_index.parquet")
+
+    shape = (len(image_index), 3, CONFIG["image_size"], CONFIG["image_size"])
+    images = np.lib.format.open_memmap(images_file + ".tmp", mode="w+", dtype=np.uint8, shape=shape)
+
+    loader = DataLoader(PNGDataset(image_index), batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"])
+    start = 0
+    for batch in tqdm(loader, desc="[Cache] images_u8.npy"):
+        images[start:start + len(batch)] = batch.numpy()
+        start += len(batch)
+
+    images.flush()
+    del images
+    image_index.to_parquet(index_file + ".tmp", index=False)
+    os.replace(images_file + ".tmp", images_file)
+    os.replace(index_file + ".tmp", index_file)
+
+    print(f"Cached {len(image_index)} images of size {CONFIG['image_size']}x{CONFIG['image_size']} to {images_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,31 @@
 import os
 import pandas as pd
-from PIL import Image
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, WeightedRandomSampler
 from sklearn.model_selection import train_test_split
-import torchvision.transforms as transforms
+from torchvision.transforms import v2
 from tqdm.auto import tqdm
 import wandb
-from sklearn.metrics import roc_auc_score, f1_score, precision_recall_curve
+from torchmetrics.functional.classification import multilabel_auroc, multilabel_f1_score, multilabel_precision_recall_curve
 import numpy as np
 from torchvision.models import densenet121, DenseNet121_Weights
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 CONFIG = {
     "model": "dannynet",
     "batch_size": 8,
+    "accum_steps": 1,  # Micro-batches per optimizer step (effective batch = batch_size * accum_steps); 1 keeps the published recipe
+    "balanced_sampling": False,  # Sample Pneumonia-positive and -negative images equally often
     "learning_rate": 0.00005,
     "epochs": 25,
     "num_workers": 2,
     "device": "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu",
     "data_dir": "/projectnb/dl4ds/projects/dca_project/nih_data",
+    "cache_dir": "/projectnb/dl4ds/projects/dca_project/nih_data/cache",
     "wandb_project": "X-Ray Classification",
     "patience": 5,
     "seed": 42,
@@ -29,66 +33,94 @@ CONFIG = {
 }
 
 # Define image transformations (consistent with CheXNet)
-transform_train = transforms.Compose([
-    transforms.RandomResizedCrop(224),
-    transforms.RandomHorizontalFlip(),
-    transforms.ColorJitter(brightness=0.1, contrast=0.1),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+# The images come pre-resized to 256×256 from the uint8 cache; everything else runs on the training device
+center_crop = v2.CenterCrop(224)
+# Random augmentation is drawn per image, so it is applied sample by sample
+augment_train = v2.Compose([
+    v2.RandomResizedCrop(224, antialias=True),
+    v2.RandomHorizontalFlip(),
+    v2.ColorJitter(brightness=0.1, contrast=0.1),
 ])
-transform_test = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+normalize = v2.Compose([
+    v2.ToDtype(torch.float32, scale=True),
+    v2.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
 ])
 
+def transform_train(inputs):
+    return normalize(torch.stack([augment_train(image) for image in inputs]))
+
+def transform_test(inputs):
+    return normalize(center_crop(inputs))
+
  # Load and modify the model
 model = densenet121(weights=DenseNet121_Weights.IMAGENET1K_V1)
 model.classifier = nn.Linear(model.classifier.in_features, 14)
 model = model.to(CONFIG["device"])
 
-class FocalLoss(nn.Module):
-    def __init__(self, alpha=1, gamma=2, reduction='mean'):
-        super(FocalLoss, self).__init__()
-        self.alpha = alpha
-        self.gamma = gamma
-        self.reduction = reduction
-        self.bce = nn.BCEWithLogitsLoss(reduction='none')
-
-    def forward(self, inputs, targets):
-        bce_loss = self.bce(inputs, targets)
-        pt = torch.exp(-bce_loss)
-        focal_loss = self.alpha * (1 - pt) ** self.gamma * bce_loss
-        if self.reduction == 'mean':
-            return focal_loss.mean()
-        elif self.reduction == 'sum':
-            return focal_loss.sum()
-        else:
-            return focal_loss
+# NHWC lets cuDNN pick its tensor-core convolution kernels; inputs are converted to match
+memory_format = torch.channels_last if CONFIG["device"] == "cuda" else torch.contiguous_format
+model = model.to(memory_format=memory_format)
+
+# Compile with Inductor on CUDA; MPS has limited torch.compile support. Module.compile()
+# compiles in place, so state_dict keys and saved checkpoints stay unchanged
+if CONFIG["device"] == "cuda":
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Input shapes are fixed, so let cuDNN benchmark and cache the fastest algorithm per layer
+    torch.backends.cudnn.benchmark = True
+    model.compile(mode="default")
+
+# Focal loss written as one pointwise expression over BCE-with-logits; on CUDA it is compiled
+# so Inductor fuses the exp/pow/mul/mean chain instead of materializing each intermediate
+def focal_loss(inputs, targets, alpha=1, gamma=2):
+    bce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction='none')
+    pt = torch.exp(-bce_loss)
+    return (alpha * (1 - pt).pow(gamma) * bce_loss).mean()
+
+if CONFIG["device"] == "cuda":
+    focal_loss = torch.compile(focal_loss)
 
 # Define loss function and optimizer
-criterion = FocalLoss(alpha=1, gamma=2)
-optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"], weight_decay=1e-5) #Added weight decay. # betas=(0.9, 0.999) - this is default in pytorch
+criterion = focal_loss
+optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"], weight_decay=1e-5, #Added weight decay. # betas=(0.9, 0.999) - this is default in pytorch
+                              fused=CONFIG["device"] == "cuda", foreach=CONFIG["device"] != "cuda")
 scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=1, factor=0.1)
 
+# Mixed precision on CUDA: bf16 on Ampere or newer (compute capability 8.x+), otherwise fp16 with
+# loss scaling. is_bf16_supported() also reports emulated bf16 on older cards, so it is not used
+use_amp = CONFIG["device"] == "cuda"
+amp_dtype = torch.bfloat16 if use_amp and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
+
 # Load the CSV file with image metadata
 data_path = CONFIG["data_dir"]
 csv_file = os.path.join(data_path, "Data_Entry_2017.csv")
-df = pd.read_csv(csv_file)
-
-# Get list of all image folders from images_001 to images_012
-image_folders = [os.path.join(data_path, f"images_{str(i).zfill(3)}", "images") for i in range(1, 13)]
-# Create a dictionary mapping image filenames to their folder paths
-image_to_folder = {}
-for folder in image_folders:
-    if os.path.exists(folder):
-        for img_file in os.listdir(folder):
-            if img_file.endswith('.png'):
-                image_to_folder[img_file] = folder
-
-# Filter the CSV to include only images that are present in the folders
-df = df[df['Image Index'].isin(image_to_folder.keys())]
+# The CSV is parsed once and snapshotted to Parquet with 'Finding Labels' as a categorical column.
+# The snapshot is rebuilt whenever the CSV is newer, and written under a per-process temporary
+# name first so an interrupted or concurrent run never leaves a partial file behind
+parquet_file = os.path.join(CONFIG["cache_dir"], "Data_Entry_2017.parquet")
+os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+if os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file):
+    df = pd.read_parquet(parquet_file)
+else:
+    df = pd.read_csv(csv_file)
+    df['Finding Labels'] = df['Finding Labels'].astype('category')
+    tmp_file = f"{parquet_file}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_file)
+    os.replace(tmp_file, parquet_file)
+
+# Images are read from the shared uint8 cache written by build_uint8_memmap.py; its index lists
+# the cached PNGs in memmap row order
+images_file = os.path.join(CONFIG["cache_dir"], "images_u8.npy")
+index_file = os.path.join(CONFIG["cache_dir"], "images_index.parquet")
+if not os.path.exists(images_file) or not os.path.exists(index_file):
+    raise FileNotFoundError(f"Image cache not found in {CONFIG['cache_dir']}, run scripts/build_uint8_memmap.py first")
+image_index = pd.read_parquet(index_file, columns=['Image Index'])
+image_index['row'] = np.arange(len(image_index))
+
+# Keep only the CSV rows whose image is present in the cache, tagging each with its memmap row
+df = df.merge(image_index, on='Image Index', how='inner')
 
 # Unique patient IDs
 unique_patients = df['Patient ID'].unique()
@@ -115,88 +147,141 @@ disease_list = [
     'Nodule', 'Pleural_Thickening', 'Pneumonia', 'Pneumothorax'
 ]
 
-# Function to convert label string to a vector
-def get_label_vector(labels_str):
-    labels = labels_str.split('|')
-
-    if labels == ['No Finding']:
-        return [0] * len(disease_list)
-    
-    else:
-        return [1 if disease in labels else 0 for disease in disease_list]
- 
-# Custom Dataset class
+# Convert the label strings of a dataframe to a (N, 14) multi-hot matrix. Only the distinct
+# label combinations (the categories) are split, then each row picks its category's vector
+# ('No Finding' is not a disease column, so those rows stay all zeros)
+def get_label_matrix(dataframe):
+    labels = dataframe['Finding Labels'].astype('category')
+    dummies = pd.Series(labels.cat.categories).str.get_dummies(sep='|')
+    category_vectors = dummies.reindex(columns=disease_list, fill_value=0).to_numpy(dtype=np.float32)
+    return category_vectors[labels.cat.codes.to_numpy()]
+
+# Custom Dataset class reading the cached uint8 images; augmentation happens on the device.
+# Only the path is stored on the Dataset: each DataLoader worker opens its own read-only memmap
+# on first use, so spawn-started workers do not receive a pickled copy of the whole array
 class CheXNetDataset(Dataset):
-    def __init__(self, dataframe, image_to_folder, transform=None):
-        self.dataframe = dataframe
-        self.image_to_folder = image_to_folder
-        self.transform = transform
+    def __init__(self, dataframe, images_file):
+        self.rows = dataframe['row'].to_numpy()
+        self.images_file = images_file
+        self.images = None
+        self.labels = get_label_matrix(dataframe)
 
     def __len__(self):
-        return len(self.dataframe)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        img_name = self.dataframe.iloc[idx]['Image Index']
-        folder = self.image_to_folder[img_name]
-
-        img_path = os.path.join(folder, img_name)
-        image = Image.open(img_path).convert('RGB')
-
-        if self.transform:
-            image = self.transform(image)
-
-        labels_str = self.dataframe.iloc[idx]['Finding Labels']
-        label_vector = get_label_vector(labels_str)
-        labels = torch.tensor(label_vector, dtype=torch.float)
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode='r')
+        # Copy the row out of the read-only memmap before handing it to torch
+        image = torch.from_numpy(self.images[self.rows[idx]].copy())
+        labels = torch.from_numpy(self.labels[idx])
 
         return image, labels
 
 # Set up DataLoaders with our custom datasets
-train_dataset = CheXNetDataset(train_df, image_to_folder, transform=transform_train)
-val_dataset = CheXNetDataset(val_df, image_to_folder, transform=transform_test)
-test_dataset = CheXNetDataset(test_df, image_to_folder, transform=transform_test)
+train_dataset = CheXNetDataset(train_df, images_file)
+val_dataset = CheXNetDataset(val_df, images_file)
+test_dataset = CheXNetDataset(test_df, images_file)
+
+# Class balance comes from per-row sampling weights rather than duplicated rows, so an epoch
+# stays len(train_df) samples long
+train_sampler = None
+if CONFIG["balanced_sampling"]:
+    is_pos = train_dataset.labels[:, disease_list.index('Pneumonia')] == 1
+    weights = np.where(is_pos, 1 / is_pos.sum(), 1 / (~is_pos).sum())
+    train_sampler = WeightedRandomSampler(weights, num_samples=len(train_dataset), replacement=True)
+
+trainloader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=train_sampler is None, sampler=train_sampler,
+                         num_workers=CONFIG["num_workers"], pin_memory=CONFIG["device"] == "cuda",
+                         persistent_workers=True, prefetch_factor=4)
+valloader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"],
+                       pin_memory=CONFIG["device"] == "cuda", persistent_workers=True, prefetch_factor=4)
+testloader = DataLoader(test_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"],
+                        pin_memory=CONFIG["device"] == "cuda", persistent_workers=True, prefetch_factor=4)
+
+# Iterates a DataLoader while copying the next batch to the device on a side CUDA stream, so the
+# host-to-device transfer overlaps with the current step. Off CUDA the batches are copied inline
+class Prefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
 
-trainloader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, num_workers=CONFIG["num_workers"])
-valloader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"])
-testloader = DataLoader(test_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"])
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            self.next_inputs, self.next_labels = next(self.iterator)
+        except StopIteration:
+            self.next_inputs, self.next_labels = None, None
+            return
+        if self.stream is None:
+            self.next_inputs = self.next_inputs.to(self.device)
+            self.next_labels = self.next_labels.to(self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = self.next_inputs.to(self.device, non_blocking=True)
+            self.next_labels = self.next_labels.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        inputs, labels = self.next_inputs, self.next_labels
+        if inputs is None:
+            raise StopIteration
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            # The tensors were allocated on the side stream; keep the allocator from reusing them early
+            inputs.record_stream(current_stream)
+            labels.record_stream(current_stream)
+        self._preload()
+        return inputs, labels
 
 
 def get_optimal_thresholds(labels, preds):
+    # One precision-recall curve per class, computed on whichever device the tensors live on
+    precision, recall, thresh = multilabel_precision_recall_curve(preds, labels, num_labels=preds.shape[1])
     thresholds = []
-    for i in range(preds.shape[1]):
-        precision, recall, thresh = precision_recall_curve(labels[:, i], preds[:, i])
-        f1_scores = 2 * (precision * recall) / (precision + recall + 1e-8)
-        best_threshold = thresh[np.argmax(f1_scores)] if len(thresh) > 0 else 0.5
+    for p, r, t in zip(precision, recall, thresh):
+        f1_scores = 2 * (p * r) / (p + r + 1e-8)
+        best_threshold = t[torch.argmax(f1_scores)].item() if len(t) > 0 else 0.5
         thresholds.append(best_threshold)
     return thresholds
 
 def evaluate(model, loader, criterion, device, desc="[Test]"):
     model.eval()
-    running_loss = 0.0
+    # Loss is summed on the device so the loop does not wait on a host sync every step
+    running_loss = torch.zeros((), device=device)
     all_labels, all_preds = [], []
-    with torch.no_grad():
-        for inputs, labels in tqdm(loader, desc=desc):
-            inputs, labels = inputs.to(device), labels.to(device)
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        for inputs, labels in tqdm(Prefetcher(loader, device), desc=desc):
+            inputs = transform_test(inputs)
+            inputs = inputs.contiguous(memory_format=memory_format)
             outputs = model(inputs)
             loss = criterion(outputs, labels)
-            running_loss += loss.item()
-            preds = torch.sigmoid(outputs)
-            all_labels.append(labels.cpu())
-            all_preds.append(preds.cpu())
-
-    all_labels = torch.cat(all_labels).numpy()
-    all_preds = torch.cat(all_preds).numpy()
+            running_loss += loss.detach()
+            preds = torch.sigmoid(outputs.float())
+            all_labels.append(labels)
+            all_preds.append(preds)
+
+    # Predictions and labels stay on the device so the metrics below run there; only the
+    # 14 per-class scores are copied back to the host
+    all_labels = torch.cat(all_labels).int()
+    all_preds = torch.cat(all_preds)
     thresholds = get_optimal_thresholds(all_labels, all_preds)
 
-    preds_binary = np.zeros_like(all_preds)
-    for i in range(all_preds.shape[1]):
-        preds_binary[:, i] = (all_preds[:, i] > thresholds[i]).astype(int)
+    preds_binary = (all_preds > torch.tensor(thresholds, device=all_preds.device)).int()
 
-    auc_scores = [roc_auc_score(all_labels[:, i], all_preds[:, i]) for i in range(14)]
-    f1_scores = [f1_score(all_labels[:, i], preds_binary[:, i]) for i in range(14)]
+    auc_scores = multilabel_auroc(all_preds, all_labels, num_labels=len(disease_list), average=None).cpu().numpy()
+    f1_scores = multilabel_f1_score(preds_binary, all_labels, num_labels=len(disease_list), average=None).cpu().numpy()
 
-    avg_auc = np.mean(auc_scores)
-    avg_f1 = np.mean(f1_scores)
+    avg_auc = float(np.mean(auc_scores))
+    avg_f1 = float(np.mean(f1_scores))
 
     for i, disease in enumerate(disease_list):
         print(f"{desc} {disease} AUC: {auc_scores[i]:.4f} | F1: {f1_scores[i]:.4f}")
@@ -204,11 +289,11 @@ def evaluate(model, loader, criterion, device, desc="[Test]"):
     print(f"{desc} Avg AUC: {avg_auc:.4f}, Avg F1: {avg_f1:.4f}")
 
     return {
-        "loss": running_loss / len(loader),
+        "loss": running_loss.item() / len(loader),
         "avg_auc": avg_auc,
         "avg_f1": avg_f1,
-        "auc_dict": dict(zip(disease_list, auc_scores)),
-        "f1_dict": dict(zip(disease_list, f1_scores)),
+        "auc_dict": dict(zip(disease_list, auc_scores.tolist())),
+        "f1_dict": dict(zip(disease_list, f1_scores.tolist())),
         "thresholds": dict(zip(disease_list, thresholds))
     }
 
@@ -217,34 +302,70 @@ def evaluate(model, loader, criterion, device, desc="[Test]"):
 def train(epoch, model, trainloader, optimizer, criterion, CONFIG):
     device = CONFIG["device"]
     model.train()
-    running_loss = 0.0
-    progress_bar = tqdm(trainloader, desc=f"Epoch {epoch+1}/{CONFIG['epochs']} [Train]", leave=True)
+    # Loss is summed on the device so the loop does not wait on a host sync every step
+    running_loss = torch.zeros((), device=device)
+    progress_bar = tqdm(Prefetcher(trainloader, device), desc=f"Epoch {epoch+1}/{CONFIG['epochs']} [Train]", leave=True)
+    accum_steps = CONFIG["accum_steps"]
+    num_batches = len(trainloader)
+    optimizer.zero_grad(set_to_none=True)
     for i, (inputs, labels) in enumerate(progress_bar):
-        inputs, labels = inputs.to(device), labels.to(device)
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.item()
-        progress_bar.set_postfix({"loss": running_loss / (i + 1)})
-    train_loss = running_loss / len(trainloader)
+        inputs = transform_train(inputs)
+        inputs = inputs.contiguous(memory_format=memory_format)
+        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+        # Gradients are averaged over accum_steps micro-batches; the last group of an epoch may be shorter
+        scaler.scale(loss / accum_steps).backward()
+        if (i + 1) % accum_steps == 0 or i + 1 == num_batches:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+        running_loss += loss.detach()
+        if i % 50 == 0:
+            progress_bar.set_postfix({"loss": (running_loss / (i + 1)).item()})
+    train_loss = running_loss.item() / num_batches
     return train_loss
 
 def validate(model, valloader, criterion, device):
     return evaluate(model, valloader, criterion, device, desc="[Validate]")
 
+# Run one training and one evaluation pass on a dummy batch so cuDNN autotuning and torch.compile
+# happen before the first real step; the BatchNorm running statistics are restored afterwards
+def prewarm(model, CONFIG):
+    device = CONFIG["device"]
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    inputs = torch.zeros(CONFIG["batch_size"], 3, CONFIG["image_size"], CONFIG["image_size"], device=device)
+    inputs = inputs.contiguous(memory_format=memory_format)
+
+    model.train()
+    with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        outputs = model(inputs)
+    outputs.float().sum().backward()
+    model.zero_grad(set_to_none=True)
+
+    model.eval()
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        model(inputs)
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+
  # Training loop with WandB and timestamped checkpoints
 wandb.init(project=CONFIG["wandb_project"], config=CONFIG)
 wandb.watch(model, log="all")
 
-transform_names = [t.__class__.__name__ for t in transform_train.transforms]
+# Prewarm after wandb.watch so its hooks are in place when torch.compile traces the model
+if CONFIG["device"] == "cuda":
+    prewarm(model, CONFIG)
+
+transform_names = [t.__class__.__name__ for t in augment_train.transforms + normalize.transforms]
 
 wandb.config.update({
     "model_architecture": "DenseNet121",
     "classifier_head": str(model.classifier),  # logs the Linear layer details
     "optimizer": optimizer.__class__.__name__,
-    "loss_fn": criterion.__class__.__name__,
+    "loss_fn": criterion.__name__,
     "scheduler": scheduler.__class__.__name__,
     "augmentation": " + ".join(transform_names)
 })
@@ -254,6 +375,15 @@ run_id = wandb.run.id
 checkpoint_dir = os.path.join("models", run_id)
 os.makedirs(checkpoint_dir, exist_ok=True)
 
+# Checkpoints are written from a CPU copy of the weights in a background thread, so the next
+# epoch starts while the file is flushed to disk; the .pth format stays loadable by the app.
+# Waiting on the previous future with .result() re-raises any error from torch.save/wandb.save
+def save_checkpoint(state_dict, checkpoint_path):
+    torch.save(state_dict, checkpoint_path)
+    wandb.save(checkpoint_path)
+
+checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+checkpoint_future = None
 best_val_auc = 0.0
 patience_counter = 0
 
@@ -280,14 +410,21 @@ for epoch in range(CONFIG["epochs"]):
         patience_counter = 0
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         checkpoint_path = os.path.join(checkpoint_dir, f"best_model_{timestamp}.pth")
-        torch.save(model.state_dict(), checkpoint_path)
-        wandb.save(checkpoint_path)
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        checkpoint_future = checkpoint_executor.submit(save_checkpoint, state_dict, checkpoint_path)
     else:
         patience_counter += 1
         if patience_counter >= CONFIG["patience"]:
             print("Early stopping triggered.")
             break
 
+# Wait for the last checkpoint to be written before reloading it; a failed save raises here
+if checkpoint_future is not None:
+    checkpoint_future.result()
+checkpoint_executor.shutdown()
+
 # Evaluate the best model
 best_checkpoint_path = sorted([os.path.join(checkpoint_dir, f) for f in os.listdir(checkpoint_dir) if f.startswith('best_model_')])[-1]
 model.load_state_dict(torch.load(best_checkpoint_path))
@@ -1,65 +1,87 @@
 import os
 import pandas as pd
-from PIL import Image
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, WeightedRandomSampler
 from sklearn.model_selection import train_test_split
-import torchvision.transforms as transforms
+from torchvision.transforms import v2
 from tqdm.auto import tqdm
 import wandb
-from sklearn.metrics import roc_auc_score, f1_score
+from torchmetrics.functional.classification import multilabel_auroc, multilabel_f1_score
 import numpy as np
-from transformers import ViTForImageClassification, ViTFeatureExtractor
+from transformers import ViTForImageClassification, ViTImageProcessor
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration settings
 CONFIG = {
     "model": "vit_transformer",
     "batch_size": 16,
+    "accum_steps": 1,  # Micro-batches per optimizer step (effective batch = batch_size * accum_steps); 1 keeps the published recipe
+    "balanced_sampling": False,  # Sample Pneumonia-positive and -negative images equally often
     "learning_rate": 0.0001,
     "epochs": 20,
     "num_workers": 1,
     "device": "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu",
     "data_dir": "/projectnb/dl4ds/projects/dca_project/nih_data",
+    "cache_dir": "/projectnb/dl4ds/projects/dca_project/nih_data/cache",
     "wandb_project": "X-Ray Classification",
     "patience": 5,
     "seed": 42,
     "image_size": 224,
 }
 
-# Define the model name and load feature extractor
+# Define the model name and load its image processor; only its size and statistics are used,
+# the preprocessing itself runs as torchvision transforms
 model_name = "google/vit-base-patch16-224"
-feature_extractor = ViTFeatureExtractor.from_pretrained(model_name)
+image_processor = ViTImageProcessor.from_pretrained(model_name)
+
+# Resizing from the 256×256 uint8 cache, rescaling and normalization with the processor's
+# statistics run on whole batches on the training device
+resize_normalize = v2.Compose([
+    v2.ToDtype(torch.float32, scale=True),
+    v2.Resize((image_processor.size["height"], image_processor.size["width"]), antialias=True),
+    v2.Normalize(image_processor.image_mean, image_processor.image_std),
+])
 
 # Define transform functions
-def transform_train(img):
-    return feature_extractor(images=img, return_tensors='pt')['pixel_values'][0]
+def transform_train(inputs):
+    return resize_normalize(inputs)
 
-def transform_test(img):
-    return feature_extractor(images=img, return_tensors='pt')['pixel_values'][0]
+def transform_test(inputs):
+    return resize_normalize(inputs)
 
 # Load the CSV file with image metadata
 data_path = CONFIG["data_dir"]
 csv_file = os.path.join(data_path, "Data_Entry_2017.csv")
 if not os.path.exists(csv_file):
     raise FileNotFoundError(f"CSV file not found at {csv_file}")
-df = pd.read_csv(csv_file)
-
-# Get list of all image folders from images_001 to images_012
-image_folders = [os.path.join(data_path, f"images_{str(i).zfill(3)}", "images") for i in range(1, 13)]
-
-# Create a dictionary mapping image filenames to their folder paths
-image_to_folder = {}
-for folder in image_folders:
-    if os.path.exists(folder):
-        for img_file in os.listdir(folder):
-            if img_file.endswith('.png'):
-                image_to_folder[img_file] = folder
-
-# Filter the CSV to include only images that are present in the folders
-df = df[df['Image Index'].isin(image_to_folder.keys())]
+# The CSV is parsed once and snapshotted to Parquet with 'Finding Labels' as a categorical column.
+# The snapshot is rebuilt whenever the CSV is newer, and written under a per-process temporary
+# name first so an interrupted or concurrent run never leaves a partial file behind
+parquet_file = os.path.join(CONFIG["cache_dir"], "Data_Entry_2017.parquet")
+os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+if os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file):
+    df = pd.read_parquet(parquet_file)
+else:
+    df = pd.read_csv(csv_file)
+    df['Finding Labels'] = df['Finding Labels'].astype('category')
+    tmp_file = f"{parquet_file}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_file)
+    os.replace(tmp_file, parquet_file)
+
+# Images are read from the shared uint8 cache written by build_uint8_memmap.py; its index lists
+# the cached PNGs in memmap row order
+images_file = os.path.join(CONFIG["cache_dir"], "images_u8.npy")
+index_file = os.path.join(CONFIG["cache_dir"], "images_index.parquet")
+if not os.path.exists(images_file) or not os.path.exists(index_file):
+    raise FileNotFoundError(f"Image cache not found in {CONFIG['cache_dir']}, run scripts/build_uint8_memmap.py first")
+image_index = pd.read_parquet(index_file, columns=['Image Index'])
+image_index['row'] = np.arange(len(image_index))
+
+# Keep only the CSV rows whose image is present in the cache, tagging each with its memmap row
+df = df.merge(image_index, on='Image Index', how='inner')
 if df.empty:
     raise ValueError("No valid images found after filtering")
 
@@ -83,44 +105,99 @@ disease_list = [
     'Nodule', 'Pleural_Thickening', 'Pneumonia', 'Pneumothorax'
 ]
 
-# Function to convert label string to a vector
-def get_label_vector(labels_str):
-    labels = labels_str.split('|')
-    if labels == ['No Finding']:
-        return [0] * len(disease_list)
-    else:
-        return [1 if disease in labels else 0 for disease in disease_list]
-
-# Custom Dataset class
+# Convert the label strings of a dataframe to a (N, 14) multi-hot matrix. Only the distinct
+# label combinations (the categories) are split, then each row picks its category's vector
+# ('No Finding' is not a disease column, so those rows stay all zeros)
+def get_label_matrix(dataframe):
+    labels = dataframe['Finding Labels'].astype('category')
+    dummies = pd.Series(labels.cat.categories).str.get_dummies(sep='|')
+    category_vectors = dummies.reindex(columns=disease_list, fill_value=0).to_numpy(dtype=np.float32)
+    return category_vectors[labels.cat.codes.to_numpy()]
+
+# Custom Dataset class reading the cached uint8 images; augmentation happens on the device.
+# Only the path is stored on the Dataset: each DataLoader worker opens its own read-only memmap
+# on first use, so spawn-started workers do not receive a pickled copy of the whole array
 class CheXNetDataset(Dataset):
-    def __init__(self, dataframe, image_to_folder, transform=None):
-        self.dataframe = dataframe
-        self.image_to_folder = image_to_folder
-        self.transform = transform
+    def __init__(self, dataframe, images_file):
+        self.rows = dataframe['row'].to_numpy()
+        self.images_file = images_file
+        self.images = None
+        self.labels = get_label_matrix(dataframe)
 
     def __len__(self):
-        return len(self.dataframe)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        img_name = self.dataframe.iloc[idx]['Image Index']
-        folder = self.image_to_folder[img_name]
-        img_path = os.path.join(folder, img_name)
-        image = Image.open(img_path).convert('RGB')
-        if self.transform:
-            image = self.transform(image)
-        labels_str = self.dataframe.iloc[idx]['Finding Labels']
-        label_vector = get_label_vector(labels_str)
-        labels = torch.tensor(label_vector, dtype=torch.float)
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode='r')
+        # Copy the row out of the read-only memmap before handing it to torch
+        image = torch.from_numpy(self.images[self.rows[idx]].copy())
+        labels = torch.from_numpy(self.labels[idx])
         return image, labels
 
 # Set up DataLoaders
-train_dataset = CheXNetDataset(train_df, image_to_folder, transform=transform_train)
-val_dataset = CheXNetDataset(val_df, image_to_folder, transform=transform_test)
-test_dataset = CheXNetDataset(test_df, image_to_folder, transform=transform_test)
+train_dataset = CheXNetDataset(train_df, images_file)
+val_dataset = CheXNetDataset(val_df, images_file)
+test_dataset = CheXNetDataset(test_df, images_file)
+
+# Class balance comes from per-row sampling weights rather than duplicated rows, so an epoch
+# stays len(train_df) samples long
+train_sampler = None
+if CONFIG["balanced_sampling"]:
+    is_pos = train_dataset.labels[:, disease_list.index('Pneumonia')] == 1
+    weights = np.where(is_pos, 1 / is_pos.sum(), 1 / (~is_pos).sum())
+    train_sampler = WeightedRandomSampler(weights, num_samples=len(train_dataset), replacement=True)
+
+trainloader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=train_sampler is None, sampler=train_sampler,
+                         num_workers=CONFIG["num_workers"], pin_memory=CONFIG["device"] == "cuda",
+                         persistent_workers=True, prefetch_factor=4)
+valloader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"],
+                       pin_memory=CONFIG["device"] == "cuda", persistent_workers=True, prefetch_factor=4)
+testloader = DataLoader(test_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"],
+                        pin_memory=CONFIG["device"] == "cuda", persistent_workers=True, prefetch_factor=4)
+
+# Iterates a DataLoader while copying the next batch to the device on a side CUDA stream, so the
+# host-to-device transfer overlaps with the current step. Off CUDA the batches are copied inline
+class Prefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
 
-trainloader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, num_workers=CONFIG["num_workers"])
-valloader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"])
-testloader = DataLoader(test_dataset, batch_size=CONFIG["batch_size"], shuffle=False, num_workers=CONFIG["num_workers"])
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            self.next_inputs, self.next_labels = next(self.iterator)
+        except StopIteration:
+            self.next_inputs, self.next_labels = None, None
+            return
+        if self.stream is None:
+            self.next_inputs = self.next_inputs.to(self.device)
+            self.next_labels = self.next_labels.to(self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = self.next_inputs.to(self.device, non_blocking=True)
+            self.next_labels = self.next_labels.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        inputs, labels = self.next_inputs, self.next_labels
+        if inputs is None:
+            raise StopIteration
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            # The tensors were allocated on the side stream; keep the allocator from reusing them early
+            inputs.record_stream(current_stream)
+            labels.record_stream(current_stream)
+        self._preload()
+        return inputs, labels
 
 # Load the pre-trained model
 model = ViTForImageClassification.from_pretrained(
@@ -130,43 +207,62 @@ model = ViTForImageClassification.from_pretrained(
 )
 model = model.to(CONFIG["device"])
 
+# Compile with Inductor on CUDA; MPS has limited torch.compile support. Module.compile()
+# compiles in place, so state_dict keys and saved checkpoints stay unchanged
+if CONFIG["device"] == "cuda":
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Input shapes are fixed, so let cuDNN benchmark and cache the fastest algorithm per layer
+    torch.backends.cudnn.benchmark = True
+    model.compile(mode="default")
+
 # Define loss function and optimizer
 criterion = nn.BCEWithLogitsLoss()
-optimizer = optim.Adam(model.parameters(), lr=CONFIG["learning_rate"], weight_decay=1e-5)
+optimizer = optim.Adam(model.parameters(), lr=CONFIG["learning_rate"], weight_decay=1e-5,
+                       fused=CONFIG["device"] == "cuda", foreach=CONFIG["device"] != "cuda")
 scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.1)
 
+# Mixed precision on CUDA: bf16 on Ampere or newer (compute capability 8.x+), otherwise fp16 with
+# loss scaling. is_bf16_supported() also reports emulated bf16 on older cards, so it is not used
+use_amp = CONFIG["device"] == "cuda"
+amp_dtype = torch.bfloat16 if use_amp and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
+
 # Evaluation function
 def evaluate(model, testloader, criterion, device, desc="[Test]"):
     model.eval()
-    running_loss = 0.0
+    # Loss is summed on the device so the loop does not wait on a host sync every step
+    running_loss = torch.zeros((), device=device)
     all_labels = []
     all_preds = []
-    with torch.no_grad():
-        progress_bar = tqdm(testloader, desc=desc, leave=True)
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        progress_bar = tqdm(Prefetcher(testloader, device), desc=desc, leave=True)
         for inputs, labels in progress_bar:
-            inputs, labels = inputs.to(device), labels.to(device)
+            inputs = transform_test(inputs)
             outputs = model(inputs).logits
             loss = criterion(outputs, labels)
-            running_loss += loss.item()
-            preds = torch.sigmoid(outputs)
-            all_labels.append(labels.cpu())
-            all_preds.append(preds.cpu())
-    all_labels = torch.cat(all_labels).numpy()
-    all_preds = torch.cat(all_preds).numpy()
-    test_loss = running_loss / len(testloader)
-
-    auc_scores = [roc_auc_score(all_labels[:, i], all_preds[:, i]) for i in range(14)]
-    avg_auc = np.mean(auc_scores)
+            running_loss += loss.detach()
+            preds = torch.sigmoid(outputs.float())
+            all_labels.append(labels)
+            all_preds.append(preds)
+    # Predictions and labels stay on the device so the metrics below run there; only the
+    # 14 per-class scores are copied back to the host
+    all_labels = torch.cat(all_labels).int()
+    all_preds = torch.cat(all_preds)
+    test_loss = running_loss.item() / len(testloader)
+
+    auc_scores = multilabel_auroc(all_preds, all_labels, num_labels=len(disease_list), average=None).cpu().numpy()
+    avg_auc = float(np.mean(auc_scores))
     for i, disease in enumerate(disease_list):
         print(f"{desc} {disease} AUC-ROC: {auc_scores[i]:.4f}")
-    auc_dict = {disease_list[i]: auc_scores[i] for i in range(14)}
+    auc_dict = {disease_list[i]: float(auc_scores[i]) for i in range(14)}
 
-    preds_binary = (all_preds > 0.5).astype(int)
-    f1_scores = [f1_score(all_labels[:, i], preds_binary[:, i]) for i in range(14)]
-    avg_f1 = np.mean(f1_scores)
+    f1_scores = multilabel_f1_score(all_preds, all_labels, num_labels=len(disease_list), threshold=0.5, average=None).cpu().numpy()
+    avg_f1 = float(np.mean(f1_scores))
     for i, disease in enumerate(disease_list):
         print(f"{desc} {disease} F1 Score: {f1_scores[i]:.4f}")
-    f1_dict = {disease_list[i]: f1_scores[i] for i in range(14)}
+    f1_dict = {disease_list[i]: float(f1_scores[i]) for i in range(14)}
     print(f"{desc} Loss: {test_loss:.4f}, Avg AUC-ROC: {avg_auc:.4f}, Avg F1 Score: {avg_f1:.4f}")
     return test_loss, avg_auc, avg_f1, auc_dict, f1_dict
 
@@ -174,28 +270,58 @@ def evaluate(model, testloader, criterion, device, desc="[Test]"):
 def train(epoch, model, trainloader, optimizer, criterion, CONFIG):
     device = CONFIG["device"]
     model.train()
-    running_loss = 0.0
-    progress_bar = tqdm(trainloader, desc=f"Epoch {epoch+1}/{CONFIG['epochs']} [Train]", leave=True)
+    # Loss is summed on the device so the loop does not wait on a host sync every step
+    running_loss = torch.zeros((), device=device)
+    progress_bar = tqdm(Prefetcher(trainloader, device), desc=f"Epoch {epoch+1}/{CONFIG['epochs']} [Train]", leave=True)
+    accum_steps = CONFIG["accum_steps"]
+    num_batches = len(trainloader)
+    optimizer.zero_grad(set_to_none=True)
     # Ensure progress_bar is closed properly
     try:
         for i, (inputs, labels) in enumerate(progress_bar):
-            inputs, labels = inputs.to(device), labels.to(device)
-            optimizer.zero_grad()
-            outputs = model(inputs).logits
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-            progress_bar.set_postfix({"loss": running_loss / (i + 1)})
+            inputs = transform_train(inputs)
+            with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+                outputs = model(inputs).logits
+                loss = criterion(outputs, labels)
+            # Gradients are averaged over accum_steps micro-batches; the last group of an epoch may be shorter
+            scaler.scale(loss / accum_steps).backward()
+            if (i + 1) % accum_steps == 0 or i + 1 == num_batches:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+            running_loss += loss.detach()
+            if i % 50 == 0:
+                progress_bar.set_postfix({"loss": (running_loss / (i + 1)).item()})
     finally:
         progress_bar.close()
-    train_loss = running_loss / len(trainloader)
+    train_loss = running_loss.item() / num_batches
     return train_loss
 
 def validate(model, valloader, criterion, device):
     val_loss, val_auc, val_f1, auc_dict, f1_dict = evaluate(model, valloader, criterion, device, desc="[Validate]")
     return val_loss, val_auc, val_f1, auc_dict, f1_dict
 
+# Run one training and one evaluation pass on a dummy batch so cuDNN autotuning and torch.compile
+# happen before the first real step; the model buffers are restored afterwards
+def prewarm(model, CONFIG):
+    device = CONFIG["device"]
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    inputs = torch.zeros(CONFIG["batch_size"], 3, CONFIG["image_size"], CONFIG["image_size"], device=device)
+
+    model.train()
+    with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        outputs = model(inputs).logits
+    outputs.float().sum().backward()
+    model.zero_grad(set_to_none=True)
+
+    model.eval()
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=use_amp):
+        model(inputs)
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+
 # Training loop with WandB and timestamped checkpoints
 try:
     wandb.init(project=CONFIG["wandb_project"], config=CONFIG)
@@ -204,10 +330,23 @@ except Exception as e:
     print(f"WandB initialization failed: {e}. Continuing without WandB.")
     wandb.init(mode="disabled")
 
+# Prewarm after wandb.watch so its hooks are in place when torch.compile traces the model
+if CONFIG["device"] == "cuda":
+    prewarm(model, CONFIG)
+
 run_id = wandb.run.id
 checkpoint_dir = os.path.join("models", run_id)
 os.makedirs(checkpoint_dir, exist_ok=True)
 
+# Checkpoints are written from a CPU copy of the weights in a background thread, so the next
+# epoch starts while the file is flushed to disk; the .pth format stays loadable by the app.
+# Waiting on the previous future with .result() re-raises any error from torch.save/wandb.save
+def save_checkpoint(state_dict, checkpoint_path):
+    torch.save(state_dict, checkpoint_path)
+    wandb.save(checkpoint_path)
+
+checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+checkpoint_future = None
 best_val_auc = 0.0
 patience_counter = 0
 
@@ -231,14 +370,21 @@ for epoch in range(CONFIG["epochs"]):
         patience_counter = 0
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         checkpoint_path = os.path.join(checkpoint_dir, f"best_model_{timestamp}.pth")
-        torch.save(model.state_dict(), checkpoint_path)
-        wandb.save(checkpoint_path)
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        checkpoint_future = checkpoint_executor.submit(save_checkpoint, state_dict, checkpoint_path)
     else:
         patience_counter += 1
         if patience_counter >= CONFIG["patience"]:
             print("Early stopping triggered.")
             break
 
+# Wait for the last checkpoint to be written before reloading it; a failed save raises here
+if checkpoint_future is not None:
+    checkpoint_future.result()
+checkpoint_executor.shutdown()
+
 # Evaluate the best model
 checkpoint_files = [os.path.join(checkpoint_dir, f) for f in os.listdir(checkpoint_dir) if f.startswith('best_model_')]
 if not checkpoint_files: